@@ -1,10 +1,18 @@
 import os
+import math
+import atexit
+import logging
+import logging.handlers
+import queue
 import subprocess
 import tempfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from openai import OpenAI
+import asyncio
+from openai import AsyncOpenAI, AuthenticationError, RateLimitError, APIConnectionError, InternalServerError
+from tenacity import AsyncRetrying, stop_after_attempt, wait_random_exponential, retry_if_exception_type
+import httpx
 import time
 import sys
+from functools import lru_cache
 
 # Get API key from environment variable or command line
 api_key = os.getenv('OPENAI_API_KEY') or (sys.argv[1] if len(sys.argv) > 1 else None)
@@ -17,198 +25,263 @@ if not api_key:
     print("\nGet your API key from: https://platform.openai.com/api-keys")
     sys.exit(1)
 
-client = OpenAI(api_key=api_key)
+# Per-chunk logging: worker coroutines only enqueue; one listener thread writes to stderr.
+# Per-chunk progress is shown with DEBUG=1; errors and retries always are.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO if os.getenv('DEBUG') == '1' else logging.WARNING)
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
 
-def compress_audio_first(input_path, output_path="compressed_audio.m4a"):
-    """Compress the entire audio file first for faster processing with medium quality"""
-    print(f"🗜️  STEP 1: Compressing entire audio file for MAXIMUM SPEED...")
-    
-    # Get original file size
-    original_size_mb = os.path.getsize(input_path) / (1024 * 1024)
-    print(f"📁 Original file size: {original_size_mb:.1f} MB")
-    
-    cmd = [
-        "ffmpeg", "-i", input_path,
-        "-vn",  # No video
-        "-map_metadata", "-1",  # Remove metadata  
-        "-ac", "1",  # Mono audio (sufficient for speech)
-        "-c:a", "aac",  # AAC codec (fast + good quality)
-        "-b:a", "32k",  # Medium bitrate for good speech quality + speed
-        "-profile:a", "aac_low",  # Low complexity profile for speed
-        "-movflags", "+faststart",  # Optimize for streaming/fast access
-        "-threads", "0",  # Use all available CPU cores for speed
-        "-preset", "ultrafast",  # Fastest encoding preset
-        "-compression_level", "1",  # Fastest compression
-        "-y", output_path  # Overwrite output
-    ]
-    
+MAX_WORKERS = 30  # Uploads are network-bound, so many in flight is cheap
+CHUNK_MINUTES = 3  # Small chunks balance load across workers and shorten the tail
+MIN_CHUNK_SECONDS = 30  # Below this, per-request API overhead dominates
+ENCODE_WORKERS = os.cpu_count() or 4  # ffmpeg encodes are CPU-bound
+
+# Shared keep-alive pool so chunk uploads reuse TCP/TLS connections (HTTP/2 multiplexed)
+client = AsyncOpenAI(
+    api_key=api_key,
+    max_retries=0,  # Retries are handled in transcribe_audio()
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_WORKERS * 2,
+            max_keepalive_connections=MAX_WORKERS * 2,
+            keepalive_expiry=60
+        ),
+        http2=True,
+        timeout=httpx.Timeout(300.0, connect=10.0)
+    )
+)
+
+@lru_cache(maxsize=1)
+def get_speech_codec_args():
+    """Get ffmpeg encoder args for 16 kHz mono speech (HE-AAC when libfdk_aac is available)"""
     try:
-        print("⚡ Compressing with MAXIMUM SPEED settings...")
-        print("🎯 Using: AAC codec, 32kbps, multi-threaded, ultrafast preset, low complexity")
-        start_time = time.time()
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        
-        end_time = time.time()
-        compression_time = end_time - start_time
-        
-        if os.path.exists(output_path):
-            compressed_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-            compression_ratio = original_size_mb / compressed_size_mb
-            
-            print(f"✅ SPEED-OPTIMIZED compression completed in {compression_time/60:.1f} minutes!")
-            print(f"📦 Compressed size: {compressed_size_mb:.1f} MB")
-            print(f"🎯 Compression ratio: {compression_ratio:.1f}x smaller")
-            print(f"💾 Space saved: {original_size_mb - compressed_size_mb:.1f} MB")
-            print(f"🚀 Quality: Medium (optimized for speech + maximum speed)")
-            
-            return output_path
-        else:
-            print("❌ Compression failed - output file not created")
-            return None
-            
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Compression failed: {e}")
-        print(f"Error output: {e.stderr}")
-        return None
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True)
+        if "libfdk_aac" in result.stdout:
+            return ("-c:a", "libfdk_aac", "-profile:a", "aac_he", "-b:a", "16k", "-ar", "16000")
+    except OSError:
+        pass
+    # Native AAC-LC fallback at a speech bitrate
+    return ("-c:a", "aac", "-b:a", "24k", "-profile:a", "aac_low", "-ar", "16000")
 
-def chunk_audio_with_ffmpeg(input_path, chunk_duration_minutes=15):
-    """Split audio into compressed chunks using ffmpeg for maximum speed"""
-    print(f"🔪 STEP 2: Chunking compressed audio into {chunk_duration_minutes}-minute segments...")
+@lru_cache(maxsize=1)
+def get_speech_resample_args():
+    """Get ffmpeg filter args for the 16 kHz downsample (soxr when ffmpeg is built with it)"""
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-buildconf"], capture_output=True, text=True)
+        if "--enable-libsoxr" in result.stdout:
+            return ("-af", "aresample=resampler=soxr:precision=20")
+    except OSError:
+        pass
+    # ffmpeg's built-in swr resampler is used for -ar 16000
+    return ()
+
+def plan_chunks(input_path, chunk_seconds=CHUNK_MINUTES * 60):
+    """Split the audio timeline into (index, start, duration) chunk windows"""
+    print(f"🔪 STEP 1: Planning {chunk_seconds/60:.0f}-minute chunks...")
     
-    # Get total duration first
     cmd = ["ffprobe", "-v", "quiet", "-show_entries", "format=duration", "-of", "csv=p=0", input_path]
     try:
         result = subprocess.run(cmd, capture_output=True, text=True, check=True)
         total_duration = float(result.stdout.strip())
-        chunk_duration_seconds = chunk_duration_minutes * 60
-        num_chunks = int(total_duration / chunk_duration_seconds) + 1
-        
-        print(f"📊 Total duration: {total_duration/3600:.1f} hours")
-        print(f"📦 Creating {num_chunks} large chunks (15-min each) for optimal API efficiency...")
-        
-        chunk_files = []
-        
-        # Create all chunks simultaneously using subprocess
-        chunk_processes = []
-        for i in range(num_chunks):
-            start_time = i * chunk_duration_seconds
-            chunk_file = f"chunk_{i:03d}.m4a"
-            
-            cmd = [
-                "ffmpeg", "-i", input_path,
-                "-ss", str(start_time),
-                "-t", str(chunk_duration_seconds),
-                "-vn", "-ac", "1", 
-                "-c:a", "aac", "-b:a", "32k",  # Same medium quality, max speed settings
-                "-profile:a", "aac_low",
-                "-threads", "0", "-preset", "ultrafast",
-                "-compression_level", "1",
-                "-y", chunk_file
-            ]
-            
-            # Start process but don't wait
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            chunk_processes.append((i, chunk_file, process))
-        
-        # Wait for all chunk creation processes to complete
-        print("🚀 Creating all large chunks simultaneously...")
-        for i, chunk_file, process in chunk_processes:
-            process.wait()
-            if os.path.exists(chunk_file) and os.path.getsize(chunk_file) > 0:
-                chunk_files.append((i, chunk_file))
-                chunk_size_mb = os.path.getsize(chunk_file) / (1024 * 1024)
-                print(f"✓ Created 15-min chunk {i+1}/{num_chunks} ({chunk_size_mb:.1f}MB)")
-            else:
-                print(f"✗ Failed to create chunk {i+1}")
-        
-        print(f"🎉 All {len(chunk_files)} large chunks created and ready for parallel transcription!")
-        return chunk_files
-        
     except Exception as e:
-        print(f"❌ Error during chunking: {e}")
+        print(f"❌ Could not read audio duration: {e}")
         return []
+    
+    chunk_seconds = max(chunk_seconds, MIN_CHUNK_SECONDS)
+    num_chunks = math.ceil(total_duration / chunk_seconds)
+    chunks = [(i, i * chunk_seconds, chunk_seconds) for i in range(num_chunks)]
+    
+    # Fold a too-short tail into the previous chunk
+    if num_chunks > 1 and total_duration - chunks[-1][1] < MIN_CHUNK_SECONDS:
+        chunks.pop()
+        index, start_seconds, _ = chunks.pop()
+        chunks.append((index, start_seconds, chunk_seconds + MIN_CHUNK_SECONDS))
+    
+    print(f"📊 Total duration: {total_duration/3600:.1f} hours")
+    print(f"📦 {len(chunks)} chunks, each encoded straight into memory and uploaded")
+    
+    return chunks
+
+# Without a seek index ffmpeg guesses seek offsets from the bitrate, so
+# independently seeked chunks of a VBR file can overlap or leave gaps
+UNINDEXED_EXTENSIONS = {'.mp3', '.aac'}
+
+def split_at_chunk_starts(input_path, chunks, work_dir):
+    """Cut MP3/ADTS input at the planned chunk starts in one linear -c copy pass (None for seekable inputs)"""
+    extension = os.path.splitext(input_path)[1].lower()
+    if extension not in UNINDEXED_EXTENSIONS or len(chunks) < 2:
+        return None
+    
+    print("✂️  Splitting at chunk boundaries (MP3/ADTS can't be seeked exactly)...")
+    cmd = [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-i", input_path,
+        "-map", "0:a:0", "-map_metadata", "-1", "-c:a", "copy",  # Copying frames in order keeps boundaries contiguous
+        "-f", "segment", "-segment_times", ",".join(str(start) for _, start, _ in chunks[1:]),
+        "-reset_timestamps", "1",
+        os.path.join(work_dir, f"segment_%03d{extension}")
+    ]
+    try:
+        subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    except Exception as e:
+        print(f"⚠️  Segment split failed, seeking chunks instead: {e}")
+        return None
+    
+    # A VBR duration estimate can overshoot, so trailing planned segments may not exist
+    segments = [os.path.join(work_dir, f"segment_{index:03d}{extension}") for index, _, _ in chunks]
+    segments = [path for path in segments if os.path.exists(path)]
+    return segments or None
+
+async def encode_chunk(input_path, start_seconds, chunk_seconds):
+    """Encode one chunk with ffmpeg straight to stdout - no temporary file (start None = whole input)"""
+    # Input seek (-ss before -i) decodes only this window; it is exact for indexed
+    # inputs, while MP3/ADTS arrive here pre-cut from split_at_chunk_starts()
+    seek_args = [] if start_seconds is None else ["-ss", str(start_seconds), "-t", str(chunk_seconds)]
+    cmd = [
+        "ffmpeg",
+        "-nostdin", "-loglevel", "error",  # Never wait on stdin; stderr carries errors only
+        *seek_args,
+        "-i", input_path,
+        "-vn",  # No video
+        "-map_metadata", "-1",  # Remove metadata
+        "-ac", "1",  # Mono audio (sufficient for speech)
+        *get_speech_resample_args(),  # High-quality 16 kHz downsample
+        *get_speech_codec_args(),  # HE-AAC 16k (or AAC-LC 24k) at 16 kHz
+        "-threads", "1",  # ENCODE_WORKERS runs one encoder per core at once
+        "-f", "mp4", "-movflags", "frag_keyframe+empty_moov",  # Fragmented m4a can be piped
+        "pipe:1"
+    ]
+    
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    audio_data, error_output = await process.communicate()
+    
+    if process.returncode != 0 or not audio_data:
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {error_output.decode(errors='replace')[-500:]}")
+    return audio_data
+
+# Transient API failures worth retrying (APITimeoutError is an APIConnectionError)
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+backoff_wait = wait_random_exponential(min=1, max=60)
+
+def wait_retry_after(retry_state):
+    """Wait as long as the server's Retry-After asks, else back off exponentially"""
+    response = getattr(retry_state.outcome.exception(), 'response', None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get('retry-after')), 60)
+        except (TypeError, ValueError):
+            pass
+    return backoff_wait(retry_state)
 
-def transcribe_file(file_path):
-    """Transcribe a single audio file"""
+def log_retry(retry_state):
+    logger.warning(f"⚠️  Retrying (attempt {retry_state.attempt_number + 1}): {retry_state.outcome.exception()}")
+
+async def transcribe_audio(audio_data, name):
+    """Transcribe a single in-memory audio chunk"""
     try:
-        with open(file_path, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=audio_file,
-                response_format="text"
-            )
+        async for attempt in AsyncRetrying(
+            wait=wait_retry_after,
+            stop=stop_after_attempt(5),
+            retry=retry_if_exception_type(RETRYABLE_ERRORS),
+            before_sleep=log_retry,
+            reraise=True
+        ):
+            with attempt:
+                transcription = await client.audio.transcriptions.create(
+                    model="gpt-4o-mini-transcribe",
+                    file=(name, audio_data, "audio/mp4"),
+                    response_format="text"
+                )
         # When response_format="text", the API returns a string directly
         return transcription
+    except AuthenticationError:
+        # A bad key fails the whole run rather than producing an error transcript
+        raise
     except Exception as e:
-        print(f"❌ Error transcribing {file_path}: {e}")
-        return f"[ERROR: Could not transcribe {file_path}]"
+        logger.error(f"❌ Error transcribing {name}: {e}")
+        return f"[ERROR: Could not transcribe {name}]"
 
-def transcribe_chunk_parallel(chunk_data):
-    """Transcribe a single chunk for parallel processing"""
-    chunk_index, chunk_file = chunk_data
+async def transcribe_chunk_parallel(input_path, chunk_data, encode_semaphore, upload_semaphore, lookahead_semaphore):
+    """Encode and transcribe a single chunk for parallel processing"""
+    chunk_index, start_seconds, chunk_seconds = chunk_data
     
     try:
         start_time = time.time()
-        print(f"🔄 Starting transcription of chunk {chunk_index + 1}...")
+        logger.info(f"🔄 Starting chunk {chunk_index + 1}...", extra={"chunk_index": chunk_index})
         
-        transcription_text = transcribe_file(chunk_file)
+        # Encoding and uploading are limited separately, so later chunks keep
+        # encoding while earlier ones are still uploading; the look-ahead slot is
+        # held until the upload ends, so encoded chunks can't pile up in memory
+        async with lookahead_semaphore:
+            async with encode_semaphore:
+                audio_data = await encode_chunk(input_path, start_seconds, chunk_seconds)
+            async with upload_semaphore:
+                transcription_text = await transcribe_audio(audio_data, f"chunk_{chunk_index:03d}.m4a")
         
         end_time = time.time()
         duration = end_time - start_time
-        print(f"✅ Completed chunk {chunk_index + 1} in {duration:.1f}s")
+        logger.info(
+            f"✅ Completed chunk {chunk_index + 1} ({len(audio_data)/(1024*1024):.1f}MB) in {duration:.1f}s",
+            extra={"chunk_index": chunk_index}
+        )
         
-        return (chunk_index, transcription_text, chunk_file)
+        return (chunk_index, transcription_text)
+    except AuthenticationError:
+        raise
     except Exception as e:
-        print(f"❌ Error processing chunk {chunk_index + 1}: {e}")
-        return (chunk_index, f"[ERROR: Could not transcribe chunk {chunk_index + 1}]", chunk_file)
+        logger.error(f"❌ Error processing chunk {chunk_index + 1}: {e}", extra={"chunk_index": chunk_index})
+        return (chunk_index, f"[ERROR: Could not transcribe chunk {chunk_index + 1}]")
 
-def process_all_chunks_parallel(chunks, max_workers=10):
-    """Process ALL chunks in parallel simultaneously for maximum speed"""
+async def process_all_chunks_parallel(input_path, chunks, max_workers=MAX_WORKERS, segments=None):
+    """Process ALL chunks concurrently on one event loop for maximum speed (from pre-cut `segments` if given)"""
     total_chunks = len(chunks)
     print(f"\n🚀 MAXIMUM SPEED MODE: Processing ALL {total_chunks} chunks in parallel!")
-    print(f"⚡ Using {min(max_workers, total_chunks)} parallel workers")
+    print(f"⚡ Using {min(ENCODE_WORKERS, total_chunks)} encoders and {min(max_workers, total_chunks)} concurrent uploads")
     
     transcriptions = {}
-    chunk_files_to_cleanup = []
     
     start_time = time.time()
     
-    with ThreadPoolExecutor(max_workers=min(max_workers, total_chunks)) as executor:
-        # Submit ALL chunks for processing simultaneously
-        future_to_chunk = {executor.submit(transcribe_chunk_parallel, chunk): chunk[0] for chunk in chunks}
-        
-        # Collect results as they complete
-        completed = 0
+    # Bound in-flight work; the next chunk starts as soon as a slot frees up
+    encode_semaphore = asyncio.Semaphore(ENCODE_WORKERS)
+    upload_semaphore = asyncio.Semaphore(max_workers)
+    lookahead_semaphore = asyncio.Semaphore(max_workers + ENCODE_WORKERS)
+    tasks = [
+        transcribe_chunk_parallel(
+            segments[chunk[0]] if segments else input_path,
+            (chunk[0], None, None) if segments else chunk,
+            encode_semaphore, upload_semaphore, lookahead_semaphore
+        )
+        for chunk in chunks
+    ]
+    
+    # Collect results as they complete
+    completed = 0
+    
+    for task in asyncio.as_completed(tasks):
+        chunk_index, text = await task
+        transcriptions[chunk_index] = text
+        completed += 1
         
-        for future in as_completed(future_to_chunk):
-            chunk_index, text, chunk_file = future.result()
-            transcriptions[chunk_index] = text
-            chunk_files_to_cleanup.append(chunk_file)
-            completed += 1
-            
-            elapsed = time.time() - start_time
-            if completed > 0:
-                eta = (elapsed / completed) * (total_chunks - completed)
-                print(f"📊 Progress: {completed}/{total_chunks} ({completed/total_chunks*100:.1f}%) | ETA: {eta/60:.1f} min")
+        elapsed = time.time() - start_time
+        if completed > 0:
+            eta = (elapsed / completed) * (total_chunks - completed)
+            logger.info(f"📊 Progress: {completed}/{total_chunks} ({completed/total_chunks*100:.1f}%) | ETA: {eta/60:.1f} min")
     
     # Combine transcriptions in order
     print("\n📝 Combining all transcriptions in correct order...")
-    full_transcription = ""
-    for i in range(total_chunks):
-        if i in transcriptions:
-            full_transcription += transcriptions[i] + "\n\n"
-        else:
-            full_transcription += f"[MISSING CHUNK {i+1}]\n\n"
-    
-    # Clean up chunk files
-    print("🧹 Cleaning up temporary chunk files...")
-    for chunk_file in chunk_files_to_cleanup:
-        try:
-            if os.path.exists(chunk_file):
-                os.remove(chunk_file)
-        except Exception as e:
-            print(f"⚠️  Warning: Could not delete {chunk_file}: {e}")
+    full_transcription = "\n\n".join(
+        transcriptions.get(i, f"[MISSING CHUNK {i+1}]") for i in range(total_chunks)
+    ) + "\n\n"
     
     total_time = time.time() - start_time
     print(f"⚡ Parallel processing completed in {total_time/60:.1f} minutes")
@@ -228,39 +301,34 @@ def main():
     # Get file size info
     file_size_mb = os.path.getsize(audio_file_path) / (1024 * 1024)
     print(f"📁 Processing audio file: {file_size_mb:.1f} MB")
-    print("🎯 MAXIMUM SPEED STRATEGY: Compress first, then chunk + parallel processing")
+    print("🎯 MAXIMUM SPEED STRATEGY: Encode each chunk in memory + parallel processing")
     
-    # STEP 1: Compress the entire file first
-    compressed_file = compress_audio_first(audio_file_path)
-    
-    if not compressed_file:
-        print("❌ Failed to compress audio. Exiting.")
-        return
-    
-    # STEP 2: Chunk the compressed audio for maximum parallel processing
-    chunks = chunk_audio_with_ffmpeg(compressed_file)
+    # STEP 1: Plan the chunk windows
+    chunks = plan_chunks(audio_file_path)
     
     if not chunks:
-        print("❌ Failed to create chunks. Exiting.")
+        print("❌ Failed to plan chunks. Exiting.")
         return
     
-    # STEP 3: Process ALL chunks in parallel simultaneously
-    print(f"\n🚀 STEP 3: MAXIMUM SPEED TRANSCRIPTION")
-    full_transcription = process_all_chunks_parallel(chunks, max_workers=10)
+    # STEP 2: Process ALL chunks in parallel simultaneously
+    print(f"\n🚀 STEP 2: MAXIMUM SPEED TRANSCRIPTION")
+    with tempfile.TemporaryDirectory(prefix="transcribe_") as work_dir:
+        segments = split_at_chunk_starts(audio_file_path, chunks, work_dir)
+        if segments is not None:
+            chunks = chunks[:len(segments)]
+        try:
+            full_transcription = asyncio.run(
+                process_all_chunks_parallel(audio_file_path, chunks, max_workers=MAX_WORKERS, segments=segments)
+            )
+        except AuthenticationError as e:
+            print(f"❌ Invalid API key: {e}")
+            return
     
     # Save transcription
     output_filename = "transcription_output.txt"
     with open(output_filename, "w", encoding="utf-8") as txt_file:
         txt_file.write(full_transcription)
     
-    # Clean up compressed file
-    try:
-        if os.path.exists(compressed_file):
-            os.remove(compressed_file)
-            print("🧹 Cleaned up compressed audio file")
-    except Exception as e:
-        print(f"⚠️  Warning: Could not delete compressed file: {e}")
-    
     # Calculate timing
     end_time = time.time()
     processing_time = end_time - start_time
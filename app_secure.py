@@ -1,39 +1,146 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, Request, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import os
+import math
+import atexit
+import ctypes
+import gc
+import logging
+import logging.handlers
+import queue
 import subprocess
 import tempfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from openai import OpenAI
+import shutil
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, RLock
+from openai import (
+    OpenAI, AsyncOpenAI, AuthenticationError,
+    RateLimitError, APIConnectionError, InternalServerError
+)
+from tenacity import (
+    Retrying, AsyncRetrying, stop_after_attempt,
+    wait_random_exponential, retry_if_exception_type
+)
+import httpx
 import time
 import uuid
+from functools import lru_cache
+from contextlib import nullcontext
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage, ImmutableMultiDict
+from werkzeug.exceptions import BadRequest
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
 import stripe
 import json
+import sqlite3
 import hashlib
 from datetime import datetime, timedelta
 import jwt
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
+from cachetools import TTLCache, cached
+
+MAX_FORM_VALUE_BYTES = 1024  # Text fields are short ids; only the file part may be large
+
+class UploadRequest(Request):
+    """Request that streams uploaded files straight into the upload folder"""
+    
+    def _load_form_data(self):
+        if 'form' in self.__dict__ or self.mimetype != 'multipart/form-data':
+            # Non-multipart bodies go through Werkzeug's own parser
+            return super()._load_form_data()
+        
+        # Parse multipart bodies in 1 MB reads with streaming-form-data, writing
+        # the file part straight to disk instead of through Werkzeug's parser
+        spool_path = os.path.join(app.config['UPLOAD_FOLDER'], f"upload_{uuid.uuid4().hex}.part")
+        self.__dict__.setdefault('spooled_paths', []).append(spool_path)
+        file_target = FileTarget(spool_path)
+        payment_target = ValueTarget(validator=MaxSizeValidator(MAX_FORM_VALUE_BYTES))
+        parser = StreamingFormDataParser(headers={'Content-Type': self.content_type})
+        parser.register('file', file_target)
+        parser.register('payment_intent_id', payment_target)
+        try:
+            while chunk := self.stream.read(1 << 20):
+                parser.data_received(chunk)
+        except (ParseFailedException, ValidationError):
+            raise BadRequest('Malformed multipart upload')
+        
+        form = {}
+        if payment_target.value:
+            try:
+                form['payment_intent_id'] = payment_target.value.decode()
+            except UnicodeDecodeError:
+                raise BadRequest('Malformed multipart upload')
+        files = {}
+        if file_target.multipart_filename is not None:
+            files['file'] = FileStorage(
+                open(spool_path, 'rb'), filename=file_target.multipart_filename,
+                name='file', content_type=file_target.multipart_content_type
+            )
+        self.__dict__['form'] = ImmutableMultiDict(form)
+        self.__dict__['files'] = ImmutableMultiDict(files)
+    
+    def close(self):
+        super().close()
+        # Remove spool files the handler didn't claim (e.g. rejected uploads)
+        for path in self.__dict__.get('spooled_paths', []):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes with orjson (status polls hit this every second)"""
+    
+    def dumps(self, obj, **kwargs):
+        # Same output as Flask's provider: sorted keys, indented only in debug
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__, static_folder='frontend/build', static_url_path='')
+app.request_class = UploadRequest
+app.json = OrjsonProvider(app)
 CORS(app)
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'outputs'
-app.config['USERS_FILE'] = 'users.json'
+app.config['USERS_FILE'] = 'users.json'  # Legacy store, imported into USERS_DB once
+app.config['USERS_DB'] = 'users.db'
+# Behind Apache/lighttpd (X-Sendfile), let the front server send transcript files itself
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE') == '1'
+
+# Logging: worker threads only enqueue records; one listener thread writes them to stderr
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO if os.getenv('DEBUG') == '1' else logging.WARNING)
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # OpenAI configuration - Use developer's API key
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
-    print("⚠️  WARNING: OpenAI API key not found in environment variables!")
-    print("Please add OPENAI_API_KEY to your .env file")
+    logger.warning("⚠️  OpenAI API key not found in environment variables! Please add OPENAI_API_KEY to your .env file")
 
 # Google OAuth configuration
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 if not GOOGLE_CLIENT_ID:
-    print("⚠️  WARNING: Google Client ID not found in environment variables!")
-    print("Please add GOOGLE_CLIENT_ID to your .env file")
+    logger.warning("⚠️  Google Client ID not found in environment variables! Please add GOOGLE_CLIENT_ID to your .env file")
 
 # Stripe configuration
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
@@ -41,9 +148,10 @@ STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY')
 
 # Validate Stripe keys are set
 if not stripe.api_key or not STRIPE_PUBLISHABLE_KEY:
-    print("⚠️  WARNING: Stripe keys not found in environment variables!")
-    print("Please create a .env file with STRIPE_SECRET_KEY and STRIPE_PUBLISHABLE_KEY")
-    print("See STRIPE_SETUP.md for instructions")
+    logger.warning(
+        "⚠️  Stripe keys not found in environment variables! Please create a .env file with "
+        "STRIPE_SECRET_KEY and STRIPE_PUBLISHABLE_KEY (see STRIPE_SETUP.md)"
+    )
 
 # Pricing configuration
 MONTHLY_PRICE = 1.99  # $1.99 per month
@@ -53,33 +161,280 @@ STRIPE_PRICE_ID = 'price_1234567890'  # Will be created in Stripe dashboard
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
-# Store transcription status
-transcription_jobs = {}
+def remove_job_output(job):
+    """Delete a job's transcript file from disk"""
+    output_file = job.get('output_file')
+    if output_file:
+        try:
+            os.remove(output_file)
+        except OSError:
+            pass
+
+class JobStore(TTLCache):
+    """Bounded job store that deletes a job's transcript when it is evicted"""
+    
+    def popitem(self):
+        job_id, job = super().popitem()
+        remove_job_output(job)
+        return job_id, job
+    
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, job in expired:
+            remove_job_output(job)
+        return expired
+
+JOB_TTL_SECONDS = 86400
+
+# Store transcription status (bounded, 24h lifetime); guard every access with jobs_lock
+transcription_jobs = JobStore(maxsize=10000, ttl=JOB_TTL_SECONDS)
+jobs_lock = Lock()
+
+# Optional Redis queue: with REDIS_URL set, jobs run in `python worker.py` processes
+# and job status lives in Redis, so every web worker reports the same view
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    from redis import Redis
+    from rq import Queue
+    redis_conn = Redis.from_url(REDIS_URL)
+    transcription_queue = Queue('transcription', connection=redis_conn)
+else:
+    redis_conn = None
+    transcription_queue = None
+
+# One writer thread keeps each job's Redis updates in order, whether they were
+# made from a job thread (waited on) or from the upload event loop (queued)
+redis_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='redis') if REDIS_URL else None
+
+class RedisJob(dict):
+    """Job status dict that writes every update through to its Redis hash"""
+    
+    def __init__(self, job_id, fields):
+        super().__init__(fields)
+        self.key = f"job:{job_id}"
+    
+    def __setitem__(self, field, value):
+        self.update({field: value})
+    
+    def update(self, fields):
+        self.update_nowait(fields).result()
+    
+    def update_nowait(self, fields):
+        """Update the job and queue its Redis write without waiting for it"""
+        super().update(fields)
+        mapping = {field: json.dumps(value) for field, value in fields.items()}
+        return redis_writer.submit(redis_conn.hset, self.key, mapping=mapping)
+
+def update_job_nowait(job, fields):
+    """Update a job's status without blocking on Redis (for code on the upload event loop)"""
+    if isinstance(job, RedisJob):
+        job.update_nowait(fields)
+    else:
+        job.update(fields)
+
+def sweep_old_outputs():
+    """Delete transcripts older than the job TTL (Redis mode has no JobStore eviction to do it)"""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for entry in os.scandir(app.config['OUTPUT_FOLDER']):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def create_job(job_id, fields):
+    """Register a new job and return its status dict"""
+    if redis_conn:
+        key = f"job:{job_id}"
+        redis_conn.hset(key, mapping={field: json.dumps(value) for field, value in fields.items()})
+        redis_conn.expire(key, JOB_TTL_SECONDS)
+        return RedisJob(job_id, fields)
+    
+    with jobs_lock:
+        transcription_jobs[job_id] = fields
+    return fields
+
+def get_job(job_id):
+    """Get a job's status dict, or None if unknown or evicted"""
+    if redis_conn:
+        data = redis_conn.hgetall(f"job:{job_id}")
+        if not data:
+            return None
+        return RedisJob(job_id, {field.decode(): json.loads(value) for field, value in data.items()})
+    
+    with jobs_lock:
+        return transcription_jobs.get(job_id)
+
+# glibc keeps freed heap pages mapped; jobs hand them back to the OS when they finish
+try:
+    malloc_trim = ctypes.CDLL('libc.so.6').malloc_trim
+except (OSError, AttributeError):
+    malloc_trim = None  # Not glibc (macOS, Windows, musl)
+
+def release_memory():
+    """Collect garbage and return freed heap memory to the OS"""
+    gc.collect()
+    if malloc_trim:
+        malloc_trim(0)
+
+# Background transcription jobs share one bounded pool
+job_executor = ThreadPoolExecutor(max_workers=(os.cpu_count() or 4) * 2, thread_name_prefix='job')
+# Separate small pool so payment lookups never queue behind long transcriptions
+stripe_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='stripe')
+
+# Optional local GPU ASR backend (requires nemo_toolkit[asr]); replaces the OpenAI API when enabled
+USE_LOCAL_ASR = os.getenv('USE_LOCAL_ASR') == '1'
+LOCAL_ASR_MODEL = "nvidia/parakeet-tdt-0.6b-v3"
+local_asr_model = None
+local_asr_lock = RLock()  # Guards loading and serializes jobs on the single GPU model
+
+def get_local_asr_model():
+    """Load the local ASR model once and keep its weights resident on the GPU"""
+    global local_asr_model
+    with local_asr_lock:
+        if local_asr_model is None:
+            import nemo.collections.asr as nemo_asr
+            model = nemo_asr.models.ASRModel.from_pretrained(model_name=LOCAL_ASR_MODEL)
+            # Local attention lets the TDT model take hours of audio in one pass
+            model.change_attention_model("rel_pos_local_attn", [256, 256])
+            model.change_subsampling_conv_chunking_factor(1)
+            local_asr_model = model
+        return local_asr_model
+
+if USE_LOCAL_ASR and not transcription_queue:
+    # Warm the model in the background so the first job doesn't pay the load
+    # (with a queue the jobs run in worker.py, which warms its own copy)
+    job_executor.submit(get_local_asr_model)
+
+# OPTIMIZATION SETTINGS
+MAX_WORKERS = 20  # Increased from 10 for more parallelization
+ENCODE_WORKERS = os.cpu_count() or 4  # ffmpeg encodes are CPU-bound
+OPTIMAL_CHUNK_MINUTES = 5  # Smaller chunks for better parallelization
+SKIP_COMPRESSION_THRESHOLD_MB = 25  # Skip compression for files under 25MB
+MIN_CHUNK_SECONDS = 30  # Below this, per-request API overhead dominates
+API_AUDIO_EXTENSIONS = {'.flac', '.m4a', '.mp3', '.mp4', '.mpeg', '.mpga', '.oga', '.ogg', '.wav', '.webm'}  # Uploaded as-is
 
 # Initialize OpenAI client with developer's API key
 if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    # Shared keep-alive pool so chunk uploads reuse TCP/TLS connections (HTTP/2 multiplexed)
+    openai_client = OpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0,  # Retries are handled by transcription_retry()
+        http_client=httpx.Client(
+            limits=httpx.Limits(
+                max_connections=MAX_WORKERS * 2,
+                max_keepalive_connections=MAX_WORKERS * 2,
+                keepalive_expiry=60
+            ),
+            http2=True,
+            timeout=httpx.Timeout(300.0, connect=10.0)
+        )
+    )
+    # Async client for chunk fan-out, driven by a dedicated event loop thread
+    async_openai_client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0,  # Retries are handled by transcription_retry()
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_WORKERS * 2,
+                max_keepalive_connections=MAX_WORKERS * 2,
+                keepalive_expiry=60
+            ),
+            http2=True,
+            timeout=httpx.Timeout(300.0, connect=10.0)
+        )
+    )
 else:
     openai_client = None
+    async_openai_client = None
 
-# User management functions
-def load_users():
-    """Load user data from file"""
-    try:
-        if os.path.exists(app.config['USERS_FILE']):
-            with open(app.config['USERS_FILE'], 'r') as f:
-                return json.load(f)
-    except:
-        pass
-    return {}
+# Event loop that runs chunk uploads for every job
+upload_loop = asyncio.new_event_loop()
+Thread(target=upload_loop.run_forever, daemon=True).start()
+
+def close_openai_clients():
+    """Close the pooled API connections on shutdown"""
+    openai_client.close()
+    # The async pool belongs to the upload loop, so it has to be closed there
+    asyncio.run_coroutine_threadsafe(async_openai_client.close(), upload_loop).result(timeout=5)
+
+if openai_client:
+    atexit.register(close_openai_clients)
+
+# Limits shared by all jobs on the upload loop: concurrent jobs split the cores
+# for ffmpeg and the HTTP connection pool for uploads instead of multiplying them
+encode_slots = asyncio.Semaphore(ENCODE_WORKERS)
+upload_slots = asyncio.Semaphore(MAX_WORKERS * 2)
 
-def save_users(users_data):
-    """Save user data to file"""
+# User store: one row per user in SQLite (WAL lets readers run alongside the writer)
+users_db = sqlite3.connect(app.config['USERS_DB'], check_same_thread=False, isolation_level=None)
+users_db.execute('PRAGMA journal_mode=WAL')
+users_db.execute('PRAGMA synchronous=NORMAL')
+users_db.execute('CREATE TABLE IF NOT EXISTS users (google_id TEXT PRIMARY KEY, json TEXT NOT NULL)')
+users_db.execute('CREATE TABLE IF NOT EXISTS usage (user_id TEXT PRIMARY KEY, json TEXT NOT NULL)')
+users_db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, json TEXT NOT NULL)')
+users_db_lock = RLock()  # Serializes the shared connection and read-modify-write updates
+
+def import_legacy_users():
+    """Copy users from the old users.json into an empty database"""
+    if not os.path.exists(app.config['USERS_FILE']):
+        return
+    if users_db.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+        return
+    try:
+        # Parse and serialize everything before the transaction opens
+        with open(app.config['USERS_FILE'], 'r') as f:
+            users = json.load(f)
+        rows = [(user_id, json.dumps(user)) for user_id, user in users.items()]
+    except Exception as e:
+        logger.error(f"Error importing user data: {e}")
+        return
+    
+    users_db.execute('BEGIN')
     try:
-        with open(app.config['USERS_FILE'], 'w') as f:
-            json.dump(users_data, f, indent=2)
+        users_db.executemany('INSERT OR IGNORE INTO users (google_id, json) VALUES (?, ?)', rows)
+        users_db.execute('COMMIT')
+        logger.info(f"📦 Imported {len(rows)} users from {app.config['USERS_FILE']}")
     except Exception as e:
-        print(f"Error saving user data: {e}")
+        # Never leave the shared autocommit connection inside an open transaction
+        users_db.execute('ROLLBACK')
+        logger.error(f"Error importing user data: {e}")
+
+import_legacy_users()
+
+# Recently read user records; a status poll or upload re-reads the same user several times
+user_cache = TTLCache(maxsize=4096, ttl=5)
+user_cache_lock = Lock()
+
+# User management functions
+def get_user(user_id):
+    """Load a single user record, or None if it doesn't exist"""
+    # Hand out a copy: callers mutate the record before saving it, and the
+    # cached one must stay exactly what is in the database
+    user = _load_user(user_id)
+    return dict(user) if user else None
+
+@cached(cache=user_cache, key=lambda user_id: user_id, lock=user_cache_lock)
+def _load_user(user_id):
+    """Read a user row - cached for a few seconds, invalidated on write"""
+    with users_db_lock:
+        row = users_db.execute('SELECT json FROM users WHERE google_id = ?', (user_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def upsert_user(user_id, user):
+    """Insert or replace a single user record"""
+    with users_db_lock:
+        users_db.execute(
+            'INSERT INTO users (google_id, json) VALUES (?, ?) '
+            'ON CONFLICT(google_id) DO UPDATE SET json = excluded.json',
+            (user_id, json.dumps(user))
+        )
+    forget_cached_user(user_id)
+
+def forget_cached_user(user_id):
+    """Drop a user's cached record after it has been written"""
+    with user_cache_lock:
+        user_cache.pop(user_id, None)
 
 def verify_google_token(token):
     """Verify Google ID token and return user info"""
@@ -97,45 +452,46 @@ def verify_google_token(token):
             'verified_email': idinfo.get('email_verified', False)
         }
     except ValueError as e:
-        print(f"Invalid Google token: {e}")
+        logger.warning(f"Invalid Google token: {e}")
         return None
 
 def get_or_create_user(google_user_info):
     """Get existing user or create new user from Google info"""
-    users = load_users()
     google_id = google_user_info['google_id']
     
-    if google_id in users:
-        # Update user info
-        users[google_id].update({
-            'name': google_user_info['name'],
-            'email': google_user_info['email'],
-            'picture': google_user_info['picture'],
-            'last_login': datetime.now().isoformat()
-        })
-    else:
-        # Create new user with free first transcription
-        users[google_id] = {
-            'google_id': google_id,
-            'name': google_user_info['name'],
-            'email': google_user_info['email'],
-            'picture': google_user_info['picture'],
-            'transcription_count': 0,
-            'subscription_active': False,
-            'subscription_end': None,
-            'subscription_id': None,
-            'created_at': datetime.now().isoformat(),
-            'last_login': datetime.now().isoformat(),
-            'has_used_free_transcription': False
-        }
-    
-    save_users(users)
-    return users[google_id]
+    with users_db_lock:
+        user = get_user(google_id)
+        if user:
+            # Update user info
+            user.update({
+                'name': google_user_info['name'],
+                'email': google_user_info['email'],
+                'picture': google_user_info['picture'],
+                'last_login': datetime.now().isoformat()
+            })
+        else:
+            # Create new user with free first transcription
+            user = {
+                'google_id': google_id,
+                'name': google_user_info['name'],
+                'email': google_user_info['email'],
+                'picture': google_user_info['picture'],
+                'transcription_count': 0,
+                'subscription_active': False,
+                'subscription_end': None,
+                'subscription_id': None,
+                'created_at': datetime.now().isoformat(),
+                'last_login': datetime.now().isoformat(),
+                'has_used_free_transcription': False
+            }
+        
+        upsert_user(google_id, user)
+    return user
 
-def check_user_subscription(user_id):
-    """Check if user has an active subscription or free transcription available"""
-    users = load_users()
-    user = users.get(user_id, {})
+def check_user_subscription(user_id, user=None):
+    """Check if user has an active subscription or free transcription available (pass `user` if already loaded)"""
+    if user is None:
+        user = get_user(user_id) or {}
     
     # Check if user has active subscription
     subscription_end = user.get('subscription_end')
@@ -152,40 +508,41 @@ def check_user_subscription(user_id):
 
 def activate_user_subscription(user_id, subscription_id):
     """Activate a monthly subscription for user"""
-    users = load_users()
-    if user_id not in users:
-        return None
-    
     # Set subscription to end in 30 days
     subscription_end = datetime.now() + timedelta(days=30)
-    users[user_id]['subscription_id'] = subscription_id
-    users[user_id]['subscription_active'] = True
-    users[user_id]['subscription_start'] = datetime.now().isoformat()
-    users[user_id]['subscription_end'] = subscription_end.isoformat()
-    users[user_id]['last_payment'] = datetime.now().isoformat()
+    patch = {
+        'subscription_id': subscription_id,
+        'subscription_active': True,
+        'subscription_start': datetime.now().isoformat(),
+        'subscription_end': subscription_end.isoformat(),
+        'last_payment': datetime.now().isoformat()
+    }
     
-    save_users(users)
-    return subscription_end
+    # Merge the fields in place with one UPDATE instead of rewriting the record
+    with users_db_lock:
+        updated = users_db.execute(
+            'UPDATE users SET json = json_patch(json, ?) WHERE google_id = ?',
+            (json.dumps(patch), user_id)
+        ).rowcount
+    forget_cached_user(user_id)
+    return subscription_end if updated else None
 
 def increment_user_transcription_count(user_id, is_free=False):
     """Increment user's transcription count"""
-    users = load_users()
-    if user_id not in users:
-        return 0
-    
-    users[user_id]['transcription_count'] = users[user_id].get('transcription_count', 0) + 1
-    users[user_id]['last_transcription'] = datetime.now().isoformat()
-    
+    patch = {'last_transcription': datetime.now().isoformat()}
     if is_free:
-        users[user_id]['has_used_free_transcription'] = True
+        patch['has_used_free_transcription'] = True
     
-    save_users(users)
-    return users[user_id]['transcription_count']
-
-# OPTIMIZATION SETTINGS
-MAX_WORKERS = 20  # Increased from 10 for more parallelization
-OPTIMAL_CHUNK_MINUTES = 5  # Smaller chunks for better parallelization
-SKIP_COMPRESSION_THRESHOLD_MB = 25  # Skip compression for files under 25MB
+    # Atomic increment, so concurrent uploads (or processes) can't lose a count
+    with users_db_lock:
+        row = users_db.execute(
+            "UPDATE users SET json = json_set(json_patch(json, ?), '$.transcription_count', "
+            "COALESCE(json_extract(json, '$.transcription_count'), 0) + 1) "
+            "WHERE google_id = ? RETURNING json_extract(json, '$.transcription_count')",
+            (json.dumps(patch), user_id)
+        ).fetchone()
+    forget_cached_user(user_id)
+    return row[0] if row else 0
 
 def get_user_identifier(request):
     """Generate a unique identifier for the user based on IP and User-Agent"""
@@ -194,298 +551,538 @@ def get_user_identifier(request):
     identifier = f"{user_ip}:{user_agent}"
     return hashlib.sha256(identifier.encode()).hexdigest()
 
-def load_usage_data():
-    """Load usage tracking data from file"""
-    try:
-        if os.path.exists(app.config['USAGE_FILE']):
-            with open(app.config['USAGE_FILE'], 'r') as f:
-                return json.load(f)
-    except:
-        pass
-    return {}
-
-def save_usage_data(data):
-    """Save usage tracking data to file"""
-    try:
-        with open(app.config['USAGE_FILE'], 'w') as f:
-            json.dump(data, f)
-    except Exception as e:
-        print(f"Error saving usage data: {e}")
-
 def increment_user_usage(user_id):
     """Increment user's usage count (for analytics)"""
-    usage_data = load_usage_data()
-    if user_id not in usage_data:
-        usage_data[user_id] = {'usage_count': 0, 'first_use': datetime.now().isoformat()}
-    
-    usage_data[user_id]['usage_count'] = usage_data[user_id].get('usage_count', 0) + 1
-    usage_data[user_id]['last_use'] = datetime.now().isoformat()
-    save_usage_data(usage_data)
-    return usage_data[user_id]['usage_count']
+    with users_db_lock:
+        row = users_db.execute('SELECT json FROM usage WHERE user_id = ?', (user_id,)).fetchone()
+        usage = json.loads(row[0]) if row else {'usage_count': 0, 'first_use': datetime.now().isoformat()}
+        
+        usage['usage_count'] = usage.get('usage_count', 0) + 1
+        usage['last_use'] = datetime.now().isoformat()
+        users_db.execute(
+            'INSERT INTO usage (user_id, json) VALUES (?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET json = excluded.json',
+            (user_id, json.dumps(usage))
+        )
+    return usage['usage_count']
+
+# Rolling chunk upload stats (EWMA) in users.db, so every process (web and RQ
+# workers) picks its chunk length from what OpenAI has recently been like
+CHUNK_STATS_ALPHA = 0.1  # Weight of the newest chunk in the moving averages
+ADAPTIVE_CHUNK_MINUTES = (2, 15)  # Bounds for the learned chunk length
+
+def load_chunk_stats():
+    """Load the shared chunk stats, or start fresh"""
+    with users_db_lock:
+        row = users_db.execute("SELECT json FROM stats WHERE name = 'chunks'").fetchone()
+    return json.loads(row[0]) if row else {'avg_latency': None, 'err_rate': 0.0, 'chunk_minutes': None}
+
+def tune_chunk_minutes(chunk_minutes, samples):
+    """Fold a job's (latency, failed) chunk samples into the shared stats and pick the next chunk length"""
+    if not samples:
+        return
+    low, high = ADAPTIVE_CHUNK_MINUTES
+    with users_db_lock:
+        try:
+            # Read and write in one write transaction, so jobs finishing in other
+            # processes merge their samples instead of overwriting each other's
+            users_db.execute('BEGIN IMMEDIATE')
+            stats = load_chunk_stats()
+            for latency, failed in samples:
+                avg_latency = stats['avg_latency']
+                stats['avg_latency'] = latency if avg_latency is None else (
+                    avg_latency + CHUNK_STATS_ALPHA * (latency - avg_latency)
+                )
+                stats['err_rate'] += CHUNK_STATS_ALPHA * (float(failed) - stats['err_rate'])
+            
+            # Grow chunks while uploads are fast and clean, halve them on errors
+            if stats['err_rate'] >= 0.01:
+                stats['chunk_minutes'] = max(low, chunk_minutes // 2)
+            elif stats['avg_latency'] < 15:
+                stats['chunk_minutes'] = min(high, chunk_minutes + 2)
+            
+            users_db.execute(
+                "INSERT INTO stats (name, json) VALUES ('chunks', ?) "
+                "ON CONFLICT(name) DO UPDATE SET json = excluded.json",
+                (json.dumps(stats),)
+            )
+            users_db.execute('COMMIT')
+        except Exception as e:
+            if users_db.in_transaction:
+                users_db.execute('ROLLBACK')
+            # Chunk sizing is best effort; never fail a finished job over it
+            logger.warning(f"⚠️  Could not update chunk stats: {e}")
 
-def get_optimal_strategy(file_path):
+def get_optimal_strategy(file_size_mb):
     """Determine the optimal processing strategy based on file size"""
-    file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-    
     if file_size_mb <= SKIP_COMPRESSION_THRESHOLD_MB:
         # Small file: Direct transcription without compression or chunking
         return "direct", None, None
-    elif file_size_mb <= 100:
-        # Medium file: Compress and chunk with 10-minute chunks
-        return "compress_chunk", 10, 15
+    
+    learned_minutes = load_chunk_stats()['chunk_minutes']
+    if file_size_mb <= 100:
+        # Medium file: Compress and chunk with 10-minute chunks (or the learned length)
+        return "compress_chunk", learned_minutes or 10, 15
     else:
-        # Large file: Aggressive compression and 5-minute chunks
-        return "compress_chunk", 5, MAX_WORKERS
+        # Large file: Aggressive compression and 5-minute chunks (or the learned length)
+        return "compress_chunk", learned_minutes or 5, MAX_WORKERS
 
-def compress_audio_fast(input_path, output_path, aggressive=False):
-    """Compress audio with speed optimizations"""
-    print(f"🗜️  Compressing audio for maximum speed...")
+def compress_audio_fast(input_path, original_size_mb=None):
+    """Compress audio with ffmpeg straight into memory - no temporary file"""
+    logger.info("🗜️  Compressing audio for maximum speed...")
     
-    original_size_mb = os.path.getsize(input_path) / (1024 * 1024)
-    print(f"📁 Original file size: {original_size_mb:.1f} MB")
-    
-    # Use more aggressive settings for larger files
-    bitrate = "24k" if aggressive else "32k"
+    if original_size_mb is None:
+        original_size_mb = os.path.getsize(input_path) / (1024 * 1024)
+    logger.info(f"📁 Original file size: {original_size_mb:.1f} MB")
     
     cmd = [
-        get_ffmpeg_path(), "-i", input_path,
+        get_ffmpeg_path(), "-nostdin", "-loglevel", "error", "-i", input_path,
         "-vn", "-map_metadata", "-1", "-ac", "1",
-        "-c:a", "aac", "-b:a", bitrate, "-profile:a", "aac_low",
-        "-movflags", "+faststart", "-threads", "0", "-preset", "ultrafast",
-        "-compression_level", "1", "-filter:a", "atempo=1.0",  # Maintain tempo
-        "-y", output_path
+        *get_speech_resample_args(),
+        *get_speech_codec_args(),
+        "-threads", "0",  # Single encode, so it can use every core
+        "-f", "mp4", "-movflags", "frag_keyframe+empty_moov",  # Fragmented m4a can be piped
+        "pipe:1"
     ]
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        
-        if os.path.exists(output_path):
-            compressed_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-            print(f"✅ Compressed to {compressed_size_mb:.1f} MB ({original_size_mb/compressed_size_mb:.1f}x smaller)")
-            return output_path
-        return None
+        # Speech-rate AAC is a few MB even for the longest "direct" inputs
+        result = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, check=True)
+        compressed_size_mb = len(result.stdout) / (1024 * 1024)
+        logger.info(f"✅ Compressed to {compressed_size_mb:.1f} MB ({original_size_mb/compressed_size_mb:.1f}x smaller)")
+        return result.stdout
     except Exception as e:
-        print(f"❌ Compression failed: {e}")
+        logger.error(f"❌ Compression failed: {e}")
         return None
 
-def transcribe_file_direct(file_path, api_key):
-    """Directly transcribe a file without chunking (for small files)"""
+# Inputs already at speech quality are cut with -c copy instead of re-encoded:
+# codec -> (ffmpeg muxer, chunk file extension, upload MIME type)
+SPEECH_COPY_FORMATS = {'aac': ('mp4', 'm4a', 'audio/mp4'), 'opus': ('ogg', 'ogg', 'audio/ogg')}
+SPEECH_COPY_MAX_BITRATE = 32000  # bit/s
+
+def probe_audio(input_path):
+    """Get duration and first audio stream info, probing each version of a file only once"""
+    stat = os.stat(input_path)
+    return _probe_audio(input_path, stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=256)
+def _probe_audio(input_path, size, mtime_ns):
+    """Run ffprobe for duration, codec, channels and bitrate - cached by path, size and mtime"""
+    cmd = [
+        get_ffprobe_path(), "-v", "quiet", "-select_streams", "a:0",
+        "-show_entries", "format=format_name,duration,bit_rate:stream=codec_name,channels,bit_rate",
+        "-of", "json", input_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    probe = json.loads(result.stdout)
+    stream = (probe.get('streams') or [{}])[0]
+    return {
+        'format_name': probe['format'].get('format_name'),
+        'duration': float(probe['format']['duration']),
+        'codec_name': stream.get('codec_name'),
+        'channels': stream.get('channels'),
+        # Ogg/WebM often only report the container bitrate
+        'bit_rate': int(stream.get('bit_rate') or probe['format'].get('bit_rate') or 0)
+    }
+
+def get_audio_duration(input_path):
+    """Get audio duration in seconds"""
+    return probe_audio(input_path)['duration']
+
+# Streams without a seek index: ffmpeg guesses seek offsets from the bitrate,
+# so independently seeked chunks of a VBR file can overlap or leave gaps
+UNINDEXED_FORMATS = {'mp3': 'mp3', 'aac': 'aac'}  # ffprobe format_name -> segment extension (aac = raw ADTS)
+
+def split_unindexed_input(input_path, chunks, work_dir):
+    """Cut MP3/ADTS input at the planned chunk starts in one linear -c copy pass.
+    
+    Returns one segment path per chunk, or None when the input can be seeked
+    accurately (or the split failed) and chunks should seek the original instead.
+    """
     try:
-        print(f"⚡ Direct transcription (file under {SKIP_COMPRESSION_THRESHOLD_MB}MB)")
-        
-        # Use global client instead of per-API-key client
-        if not openai_client:
-            print("❌ OpenAI client not initialized")
-            return "[ERROR: OpenAI client not initialized]"
-        
-        with open(file_path, "rb") as audio_file:
-            transcription = openai_client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=audio_file,
-                response_format="text"
-            )
-        return transcription
+        extension = UNINDEXED_FORMATS.get(probe_audio(input_path)['format_name'])
+    except Exception:
+        return None
+    if not extension or len(chunks) < 2:
+        return None
+    
+    # Copying frames in order keeps segment boundaries exactly contiguous
+    cmd = [
+        get_ffmpeg_path(), "-nostdin", "-loglevel", "error", "-i", input_path,
+        "-map", "0:a:0", "-map_metadata", "-1", "-c:a", "copy",
+        "-f", "segment", "-segment_times", ",".join(str(start) for _, start, _ in chunks[1:]),
+        "-reset_timestamps", "1",
+        os.path.join(work_dir, f"segment_%03d.{extension}")
+    ]
+    try:
+        subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
     except Exception as e:
-        print(f"❌ Error transcribing: {e}")
-        return f"[ERROR: Could not transcribe file - {str(e)}]"
+        logger.warning(f"⚠️  Segment split failed, seeking chunks instead: {e}")
+        return None
+    
+    # The estimated duration of a VBR file can be off, so the last planned
+    # segments may not exist; the final real segment holds the remainder
+    segments = [os.path.join(work_dir, f"segment_{index:03d}.{extension}") for index, _, _ in chunks]
+    segments = [path if os.path.exists(path) else None for path in segments]
+    return segments if segments[0] else None
 
-def chunk_audio_parallel(input_path, chunk_duration_minutes):
-    """Split audio into chunks with parallel processing"""
-    cmd = [get_ffprobe_path(), "-v", "quiet", "-show_entries", "format=duration", "-of", "csv=p=0", input_path]
+def get_chunk_copy_format(input_path):
+    """Muxer, extension and MIME type to stream-copy chunks into, or None if the input needs re-encoding"""
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        total_duration = float(result.stdout.strip())
-        chunk_duration_seconds = chunk_duration_minutes * 60
-        num_chunks = int(total_duration / chunk_duration_seconds) + 1
-        
-        print(f"📊 Creating {num_chunks} chunks ({chunk_duration_minutes} min each)")
-        
-        chunk_files = []
+        info = probe_audio(input_path)
+    except Exception:
+        return None
+    if info['channels'] != 1 or not 0 < info['bit_rate'] <= SPEECH_COPY_MAX_BITRATE:
+        return None
+    return SPEECH_COPY_FORMATS.get(info['codec_name'])
+
+def plan_chunks(input_path, chunk_seconds):
+    """Split the audio timeline into (index, start, duration) chunk windows"""
+    try:
+        total_duration = get_audio_duration(input_path)
+        chunk_seconds = max(chunk_seconds, MIN_CHUNK_SECONDS)
+        num_chunks = math.ceil(total_duration / chunk_seconds)
+        chunks = [(i, i * chunk_seconds, chunk_seconds) for i in range(num_chunks)]
         
-        # Use ThreadPoolExecutor for parallel chunk creation
-        with ThreadPoolExecutor(max_workers=min(num_chunks, 10)) as executor:
-            futures = []
-            
-            for i in range(num_chunks):
-                start_time = i * chunk_duration_seconds
-                chunk_file = f"temp_chunk_{uuid.uuid4().hex[:8]}_{i:03d}.m4a"
-                
-                cmd = [
-                    get_ffmpeg_path(), "-i", input_path, "-ss", str(start_time),
-                    "-t", str(chunk_duration_seconds), "-vn", "-ac", "1", 
-                    "-c:a", "aac", "-b:a", "24k", "-profile:a", "aac_low",
-                    "-threads", "0", "-preset", "ultrafast",
-                    "-y", chunk_file
-                ]
-                
-                future = executor.submit(subprocess.run, cmd, capture_output=True, text=True)
-                futures.append((i, chunk_file, future))
-            
-            # Collect results
-            for i, chunk_file, future in futures:
-                try:
-                    future.result()  # Wait for completion
-                    if os.path.exists(chunk_file) and os.path.getsize(chunk_file) > 0:
-                        chunk_files.append((i, chunk_file))
-                except:
-                    print(f"✗ Failed to create chunk {i+1}")
+        # Fold a too-short tail into the previous chunk
+        if num_chunks > 1 and total_duration - chunks[-1][1] < MIN_CHUNK_SECONDS:
+            chunks.pop()
+            index, start_seconds, _ = chunks.pop()
+            chunks.append((index, start_seconds, chunk_seconds + MIN_CHUNK_SECONDS))
         
-        print(f"✅ Created {len(chunk_files)} chunks successfully")
-        return chunk_files
+        logger.info(f"📊 Planned {len(chunks)} chunks ({chunk_seconds/60:.0f} min each)")
+        return chunks
         
     except Exception as e:
-        print(f"❌ Error during chunking: {e}")
+        logger.error(f"❌ Error reading audio duration: {e}")
         return []
 
-def transcribe_file(file_path, api_key):
-    """Transcribe a single audio file"""
+async def encode_chunk_async(input_path, start_seconds, chunk_seconds, copy_format=None):
+    """Encode (or, with `copy_format`, stream-copy) one chunk with ffmpeg straight to stdout - no temporary file.
+    
+    With `start_seconds` None the whole input is one chunk (a pre-cut segment).
+    """
+    cmd = [get_ffmpeg_path(), "-nostdin", "-loglevel", "error"]
+    if start_seconds is not None:
+        # -ss before -i seeks without decoding up to the seek point. It is only
+        # sample-accurate for indexed inputs (MP4/M4A, Ogg, WebM, FLAC, WAV);
+        # MP3/ADTS are pre-cut by split_unindexed_input() instead
+        cmd += ["-ss", str(start_seconds), "-t", str(chunk_seconds)]
+    cmd += ["-i", input_path, "-vn", "-map_metadata", "-1"]
+    if copy_format:
+        cmd += ["-c:a", "copy"]
+        if copy_format[0] == "mp4":
+            # Raw ADTS (.aac) input needs its headers converted for MP4; no-op for MP4 input
+            cmd += ["-bsf:a", "aac_adtstoasc"]
+    else:
+        cmd += [
+            "-ac", "1",
+            *get_speech_resample_args(),
+            *get_speech_codec_args(),
+            "-threads", "1"  # ENCODE_WORKERS runs one encoder per core at once
+        ]
+    muxer = copy_format[0] if copy_format else "mp4"
+    cmd += ["-f", muxer]
+    if muxer == "mp4":
+        cmd += ["-movflags", "frag_keyframe+empty_moov"]  # Fragmented m4a can be piped
+    cmd.append("pipe:1")
+    
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    audio_data, error_output = await process.communicate()
+    
+    if process.returncode != 0 or not audio_data:
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {error_output.decode(errors='replace')[-500:]}")
+    return audio_data
+
+# Request options shared by the direct and chunked paths; the language hint skips auto-detection
+TRANSCRIPTION_OPTIONS = {'model': "gpt-4o-mini-transcribe", 'response_format': "text", 'language': "en"}
+
+# Transient API failures worth retrying (APITimeoutError is an APIConnectionError)
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+backoff_wait = wait_random_exponential(min=1, max=60)
+
+def wait_retry_after(retry_state):
+    """Wait as long as the server's Retry-After asks, else back off exponentially"""
+    response = getattr(retry_state.outcome.exception(), 'response', None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get('retry-after')), 60)
+        except (TypeError, ValueError):
+            pass
+    return backoff_wait(retry_state)
+
+def transcription_retry(job, name, use_async=False):
+    """Retry policy for a transcription call; each retry is recorded in the job's warnings"""
+    def record_retry(retry_state):
+        message = f"Retrying {name} (attempt {retry_state.attempt_number + 1}): {retry_state.outcome.exception()}"
+        logger.warning(f"⚠️  {message}")
+        if job is not None:
+            update_job_nowait(job, {'warnings': job.get('warnings', []) + [message]})
+    
+    retrying_class = AsyncRetrying if use_async else Retrying
+    return retrying_class(
+        wait=wait_retry_after,
+        stop=stop_after_attempt(5),
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        before_sleep=record_retry,
+        reraise=True
+    )
+
+def transcribe_file_direct(file_path, job=None, file_size_mb=None):
+    """Directly transcribe a file without chunking (for small files)"""
     try:
+        logger.info(f"⚡ Direct transcription (file under {SKIP_COMPRESSION_THRESHOLD_MB}MB)")
+        
         # Use global client instead of per-API-key client
         if not openai_client:
-            print("❌ OpenAI client not initialized")
+            logger.error("❌ OpenAI client not initialized")
             return "[ERROR: OpenAI client not initialized]"
         
-        with open(file_path, "rb") as audio_file:
-            transcription = openai_client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=audio_file,
-                response_format="text",
-                language="en"  # Specify language for faster processing
-            )
+        name = os.path.basename(file_path)
+        if os.path.splitext(name)[1].lower() in API_AUDIO_EXTENSIONS:
+            # Pass the open file rather than its bytes: httpx streams the multipart
+            # body from disk in 64 KB reads with a precomputed Content-Length
+            open_upload = lambda: open(file_path, "rb")
+        else:
+            # The API can't read this container, so pipe it through ffmpeg into memory
+            audio_data = compress_audio_fast(file_path, file_size_mb)
+            if not audio_data:
+                return "[ERROR: Could not convert audio for transcription]"
+            open_upload = lambda: nullcontext((f"{os.path.splitext(name)[0]}.m4a", audio_data, "audio/mp4"))
+        
+        for attempt in transcription_retry(job, name):
+            with attempt, open_upload() as upload:
+                transcription = openai_client.audio.transcriptions.create(
+                    file=upload, **TRANSCRIPTION_OPTIONS
+                )
+        return transcription
+    except AuthenticationError:
+        # A bad key fails the whole job rather than producing an error transcript
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error transcribing: {e}")
+        return f"[ERROR: Could not transcribe file - {str(e)}]"
+
+def transcribe_file_local(file_path, work_dir):
+    """Transcribe a whole file with the local ASR model (no chunking)"""
+    wav_path = os.path.join(work_dir, 'audio.wav')
+    
+    # The model expects 16 kHz mono PCM
+    cmd = [
+        get_ffmpeg_path(), "-nostdin", "-loglevel", "error", "-i", file_path,
+        "-vn", "-ac", "1", *get_speech_resample_args(), "-ar", "16000", "-y", wav_path
+    ]
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    
+    with local_asr_lock:
+        output = get_local_asr_model().transcribe([wav_path])
+    return output[0].text
+
+async def transcribe_chunk_async(client, audio_data, name, job=None, mime_type="audio/mp4", samples=None):
+    """Transcribe a single in-memory audio chunk on the upload event loop (appending (latency, failed) to `samples`)"""
+    started = time.monotonic()
+    attempts = 0
+    try:
+        async for attempt in transcription_retry(job, name, use_async=True):
+            with attempt:
+                attempts += 1
+                transcription = await client.audio.transcriptions.create(
+                    file=(name, audio_data, mime_type), **TRANSCRIPTION_OPTIONS
+                )
+        # A chunk that needed retries counts as an error for chunk sizing
+        if samples is not None:
+            samples.append((time.monotonic() - started, attempts > 1))
         return transcription
+    except AuthenticationError:
+        # A bad key fails the whole job rather than producing an error transcript
+        raise
     except Exception as e:
-        print(f"❌ Error transcribing {file_path}: {e}")
-        return f"[ERROR: Could not transcribe {file_path} - {str(e)}]"
+        if samples is not None:
+            samples.append((time.monotonic() - started, True))
+        logger.error(f"❌ Error transcribing {name}: {e}")
+        return f"[ERROR: Could not transcribe {name} - {str(e)}]"
+
+async def transcribe_chunks_async(job, input_path, chunks, workers, start_time, samples=None, segments=None):
+    """Encode and transcribe all chunks concurrently with at most `workers` uploads in flight"""
+    # Encodes and uploads are limited separately, so later chunks keep
+    # encoding while earlier ones are still uploading
+    upload_semaphore = asyncio.Semaphore(workers)
+    # A chunk holds a look-ahead slot from encode until its upload ends, so at most
+    # this many encoded chunks sit in memory however far ffmpeg outpaces the API
+    lookahead_semaphore = asyncio.Semaphore(workers + ENCODE_WORKERS)
+    
+    # plan_chunks already probed the file, so this is a cache hit
+    copy_format = get_chunk_copy_format(input_path)
+    if copy_format:
+        logger.info("⏩ Input is already low-bitrate mono speech - copying chunks without re-encoding")
+    extension, mime_type = copy_format[1:] if copy_format else ("m4a", "audio/mp4")
+    
+    async def transcribe_bounded(chunk_index, start_seconds, chunk_seconds):
+        if segments and segments[chunk_index] is None:
+            # The file ended before this planned chunk (VBR duration estimate)
+            return chunk_index, ""
+        async with lookahead_semaphore:
+            async with encode_slots:
+                try:
+                    if segments:
+                        audio_data = await encode_chunk_async(segments[chunk_index], None, None, copy_format)
+                    else:
+                        audio_data = await encode_chunk_async(input_path, start_seconds, chunk_seconds, copy_format)
+                except Exception as e:
+                    logger.error(f"✗ Error encoding chunk {chunk_index+1}: {e}", extra={"chunk_index": chunk_index})
+                    return chunk_index, f"[ERROR in chunk {chunk_index+1}]"
+            async with upload_semaphore, upload_slots:
+                text = await transcribe_chunk_async(
+                    async_openai_client, audio_data, f"chunk_{chunk_index:03d}.{extension}", job, mime_type, samples
+                )
+        return chunk_index, text
+    
+    transcriptions = {}
+    completed = 0
+    tasks = [asyncio.ensure_future(transcribe_bounded(*chunk)) for chunk in chunks]
+    
+    for task in asyncio.as_completed(tasks):
+        try:
+            chunk_index, text = await task
+        except AuthenticationError:
+            # No point uploading the remaining chunks with a rejected key
+            for pending in tasks:
+                pending.cancel()
+            raise
+        transcriptions[chunk_index] = text
+        completed += 1
+        
+        progress = 30 + (completed / len(chunks)) * 60
+        update_job_nowait(job, {'progress': int(progress), 'completed_chunks': completed})
+        
+        # Log progress
+        elapsed = time.time() - start_time
+        rate = completed / (elapsed / 60) if elapsed > 0 else 0
+        logger.info(
+            f"✓ Chunk {completed}/{len(chunks)} | {rate:.1f} chunks/min", extra={"chunk_index": chunk_index}
+        )
+    
+    return transcriptions
 
 def process_transcription_optimized(job_id, audio_file_path):
     """Process transcription with optimal strategy based on file size"""
+    job = get_job(job_id)
+    if job is None:
+        return
+    if redis_conn:
+        sweep_old_outputs()
+    
+    # Scratch space for this job only; removed in the finally block however the job ends
+    job_tmp = tempfile.mkdtemp(prefix=f'job_{job_id}_')
+    output_file = os.path.join(app.config['OUTPUT_FOLDER'], f"transcription_{job_id}.txt")
     try:
         start_time = time.time()
         
         # Check if OpenAI client is initialized
-        if not openai_client:
-            transcription_jobs[job_id]['status'] = 'error'
-            transcription_jobs[job_id]['message'] = 'OpenAI API key not configured'
+        if not openai_client and not USE_LOCAL_ASR:
+            job['status'] = 'error'
+            job['message'] = 'OpenAI API key not configured'
             return
         
         # Determine optimal strategy
-        strategy, chunk_minutes, workers = get_optimal_strategy(audio_file_path)
+        # Stat the upload once; the size drives every decision below
         file_size_mb = os.path.getsize(audio_file_path) / (1024 * 1024)
+        strategy, chunk_minutes, workers = get_optimal_strategy(file_size_mb)
+        chunk_samples = []  # (latency, failed) per chunk, for chunk sizing
         
-        if strategy == "direct":
-            # Small file: Direct transcription
-            transcription_jobs[job_id]['status'] = 'transcribing'
-            transcription_jobs[job_id]['progress'] = 50
-            transcription_jobs[job_id]['message'] = f'Direct transcription ({file_size_mb:.1f}MB file)'
+        if USE_LOCAL_ASR:
+            # Local GPU model: whole file in one pass, no API round trips
+            job['status'] = 'transcribing'
+            job['progress'] = 50
+            job['message'] = f'Local transcription ({file_size_mb:.1f}MB file)'
             
-            full_transcription = transcribe_file_direct(audio_file_path, None)
+            transcript_parts = [transcribe_file_local(audio_file_path, job_tmp)]
             
-        else:
-            # Larger files: Compress and chunk
-            transcription_jobs[job_id]['status'] = 'compressing'
-            transcription_jobs[job_id]['progress'] = 10
+        elif strategy == "direct":
+            # Small file: Direct transcription
+            job['status'] = 'transcribing'
+            job['progress'] = 50
+            job['message'] = f'Direct transcription ({file_size_mb:.1f}MB file)'
             
-            # Compress
-            compressed_file = compress_audio_fast(
-                audio_file_path, 
-                f"temp_compressed_{job_id}.m4a",
-                aggressive=(file_size_mb > 100)
-            )
+            transcript_parts = [transcribe_file_direct(audio_file_path, job, file_size_mb)]
             
-            if not compressed_file:
-                transcription_jobs[job_id]['status'] = 'error'
-                transcription_jobs[job_id]['message'] = 'Compression failed'
-                return
-            
-            transcription_jobs[job_id]['status'] = 'chunking'
-            transcription_jobs[job_id]['progress'] = 20
+        else:
+            # Larger files: Each chunk is compressed in memory and uploaded as it's encoded
+            job['status'] = 'chunking'
+            job['progress'] = 20
             
-            # Chunk with optimal duration
-            chunks = chunk_audio_parallel(compressed_file, chunk_minutes)
+            chunks = plan_chunks(audio_file_path, chunk_minutes * 60)
             
             if not chunks:
-                transcription_jobs[job_id]['status'] = 'error'
-                transcription_jobs[job_id]['message'] = 'Chunking failed'
+                job['status'] = 'error'
+                job['message'] = 'Could not read audio duration'
                 return
             
-            transcription_jobs[job_id]['status'] = 'transcribing'
-            transcription_jobs[job_id]['progress'] = 30
-            transcription_jobs[job_id]['total_chunks'] = len(chunks)
+            # MP3/ADTS can't be seeked sample-accurately, so cut them in one pass first
+            segments = split_unindexed_input(audio_file_path, chunks, job_tmp)
             
-            # Transcribe with maximum parallelization
-            transcriptions = {}
-            chunk_files_to_cleanup = []
+            job['status'] = 'transcribing'
+            job['progress'] = 30
+            job['total_chunks'] = len(chunks)
             
-            with ThreadPoolExecutor(max_workers=workers) as executor:
-                futures = {}
-                
-                # Submit all chunks at once
-                for chunk_index, chunk_file in chunks:
-                    future = executor.submit(transcribe_file, chunk_file, None)
-                    futures[future] = (chunk_index, chunk_file)
-                
-                completed = 0
-                for future in as_completed(futures):
-                    chunk_index, chunk_file = futures[future]
-                    chunk_files_to_cleanup.append(chunk_file)
-                    
-                    try:
-                        transcriptions[chunk_index] = future.result()
-                        completed += 1
-                        
-                        progress = 30 + (completed / len(chunks)) * 60
-                        transcription_jobs[job_id]['progress'] = int(progress)
-                        transcription_jobs[job_id]['completed_chunks'] = completed
-                        
-                        # Log progress
-                        elapsed = time.time() - start_time
-                        rate = completed / (elapsed / 60) if elapsed > 0 else 0
-                        print(f"✓ Chunk {completed}/{len(chunks)} | {rate:.1f} chunks/min")
-                        
-                    except Exception as e:
-                        transcriptions[chunk_index] = f"[ERROR in chunk {chunk_index+1}]"
-                        print(f"✗ Error in chunk {chunk_index+1}: {e}")
+            # Transcribe with maximum parallelization on the shared upload loop.
+            # (The Batch API can't be used here: it doesn't accept /v1/audio/transcriptions.)
+            transcriptions = asyncio.run_coroutine_threadsafe(
+                transcribe_chunks_async(job, audio_file_path, chunks, workers, start_time, chunk_samples, segments),
+                upload_loop
+            ).result()
             
-            # Combine transcriptions
-            full_transcription = ""
-            for i in range(len(chunks)):
-                if i in transcriptions:
-                    full_transcription += transcriptions[i] + "\n\n"
-            
-            # Cleanup
-            try:
-                os.remove(compressed_file)
-                for chunk_file in chunk_files_to_cleanup:
-                    if os.path.exists(chunk_file):
-                        os.remove(chunk_file)
-            except:
-                pass
-        
-        # Save result
-        output_file = os.path.join(app.config['OUTPUT_FOLDER'], f"transcription_{job_id}.txt")
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(full_transcription)
+            # Combine transcriptions in chunk order (written piece by piece, never joined)
+            transcript_parts = [
+                part for i in range(len(chunks)) if transcriptions.get(i)
+                for part in (transcriptions[i], "\n\n")
+            ]
         
-        # Clean up original
-        try:
-            os.remove(audio_file_path)
-        except:
-            pass
+        # Save result under a temp name, so /download never serves a half-written file
+        with open(output_file + '.tmp', "w", encoding="utf-8", buffering=1 << 20) as f:
+            f.writelines(transcript_parts)
+        os.replace(output_file + '.tmp', output_file)
         
         # Calculate final stats
         total_time = time.time() - start_time
-        transcription_jobs[job_id]['status'] = 'completed'
-        transcription_jobs[job_id]['progress'] = 100
-        transcription_jobs[job_id]['output_file'] = output_file
-        transcription_jobs[job_id]['processing_time'] = f"{total_time/60:.1f} minutes"
-        transcription_jobs[job_id]['processing_speed'] = f"{file_size_mb/(total_time/60):.1f} MB/min"
+        job['status'] = 'completed'
+        job['progress'] = 100
+        job['output_file'] = output_file
+        job['processing_time'] = f"{total_time/60:.1f} minutes"
+        job['processing_speed'] = f"{file_size_mb/(total_time/60):.1f} MB/min"
         
-        print(f"🎉 Completed in {total_time/60:.1f} minutes ({file_size_mb/(total_time/60):.1f} MB/min)")
+        logger.info(f"🎉 Completed in {total_time/60:.1f} minutes ({file_size_mb/(total_time/60):.1f} MB/min)")
         
+        # Only once the transcript is safely saved: this may wait on another writer
+        tune_chunk_minutes(chunk_minutes, chunk_samples)
+        
+    except AuthenticationError as e:
+        job['status'] = 'error'
+        job['message'] = 'Invalid API key'
+        logger.error(f"❌ OpenAI rejected the API key: {e}")
     except Exception as e:
-        transcription_jobs[job_id]['status'] = 'error'
-        transcription_jobs[job_id]['message'] = str(e)
-        print(f"❌ Fatal error: {e}")
+        job['status'] = 'error'
+        job['message'] = str(e)
+        logger.error(f"❌ Fatal error: {e}")
+    finally:
+        # Clean up the original and scratch files, even when the job failed
+        try:
+            os.remove(audio_file_path)
+        except OSError:
+            pass
+        shutil.rmtree(job_tmp, ignore_errors=True)
+        try:
+            os.remove(output_file + '.tmp')  # Left behind only if saving failed
+        except FileNotFoundError:
+            pass
+        
+        # Chunk audio and transcripts are freed by now; don't let RSS ratchet up between jobs
+        release_memory()
 
 @app.route('/')
 def index():
@@ -567,7 +1164,7 @@ def google_auth():
         user = get_or_create_user(google_user_info)
         
         # Check subscription status
-        subscription_active, subscription_end, subscription_type = check_user_subscription(user['google_id'])
+        subscription_active, subscription_end, subscription_type = check_user_subscription(user['google_id'], user)
         
         return jsonify({
             'success': True,
@@ -585,7 +1182,7 @@ def google_auth():
         })
         
     except Exception as e:
-        print(f"Authentication error: {e}")
+        logger.error(f"Authentication error: {e}")
         return jsonify({'error': 'Authentication failed'}), 500
 
 @app.route('/api/auth/logout', methods=['POST'])
@@ -607,12 +1204,11 @@ def get_user_status():
         if not user_id:
             return jsonify({'error': 'User ID not provided'}), 401
         
-        users = load_users()
-        user = users.get(user_id)
+        user = get_user(user_id)
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        subscription_active, subscription_end, subscription_type = check_user_subscription(user_id)
+        subscription_active, subscription_end, subscription_type = check_user_subscription(user_id, user)
         
         return jsonify({
             'user': {
@@ -629,13 +1225,13 @@ def get_user_status():
         })
         
     except Exception as e:
-        print(f"Error getting user status: {e}")
+        logger.error(f"Error getting user status: {e}")
         return jsonify({'error': 'Failed to get user status'}), 500
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    # Check if OpenAI is configured
-    if not openai_client:
+    # Check if OpenAI (or the local ASR backend) is configured
+    if not openai_client and not USE_LOCAL_ASR:
         return jsonify({'error': 'Service temporarily unavailable - OpenAI not configured'}), 503
     
     # Get authenticated user
@@ -643,17 +1239,18 @@ def upload_file():
     if not user_id:
         return jsonify({'error': 'Authentication required'}), 401
     
-    users = load_users()
-    user = users.get(user_id)
+    user = get_user(user_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
     # Check user subscription or free transcription availability
-    subscription_active, subscription_end, subscription_type = check_user_subscription(user_id)
+    subscription_active, subscription_end, subscription_type = check_user_subscription(user_id, user)
     
     # If not subscribed and no free transcription available, check for payment
+    payment_future = None
     if not subscription_active:
-        payment_intent_id = request.form.get('payment_intent_id')
+        # The header lets the Stripe lookup start before the upload body is read
+        payment_intent_id = request.headers.get('X-Payment-Intent-ID') or request.form.get('payment_intent_id')
         if not payment_intent_id:
             return jsonify({
                 'error': 'Monthly subscription required ($1.99/month for unlimited transcriptions)',
@@ -663,9 +1260,20 @@ def upload_file():
                 }
             }), 402
         
+        payment_future = stripe_executor.submit(stripe.PaymentIntent.retrieve, payment_intent_id)
+    
+    # Reading the file streams the upload in while Stripe answers
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file selected'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    if payment_future is not None:
         # Verify payment was successful and activate subscription
         try:
-            payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+            payment_intent = payment_future.result(timeout=10)
             if payment_intent.status != 'succeeded':
                 return jsonify({'error': 'Payment not completed'}), 402
             
@@ -677,13 +1285,6 @@ def upload_file():
         except Exception as e:
             return jsonify({'error': 'Invalid payment'}), 402
     
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file selected'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
-    
     if file:
         # Increment transcription count
         is_free_transcription = (subscription_type == 'free')
@@ -692,10 +1293,12 @@ def upload_file():
         job_id = str(uuid.uuid4())
         filename = secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{job_id}_{filename}")
-        file.save(filepath)
+        # The upload is already on disk in the upload folder; move it into place
+        file.stream.close()
+        os.replace(file.stream.name, filepath)
         
         # Initialize job status
-        transcription_jobs[job_id] = {
+        create_job(job_id, {
             'status': 'uploaded',
             'progress': 0,
             'filename': filename,
@@ -704,13 +1307,16 @@ def upload_file():
             'subscription_active': subscription_active,
             'subscription_type': subscription_type,
             'is_free_transcription': is_free_transcription
-        }
+        })
         
         # Start optimized transcription in background
-        from threading import Thread
-        thread = Thread(target=process_transcription_optimized, args=(job_id, filepath))
-        thread.daemon = True
-        thread.start()
+        if transcription_queue:
+            # Referenced by import path so worker.py can resolve it
+            transcription_queue.enqueue(
+                'app_secure.process_transcription_optimized', job_id, filepath, job_timeout=3600
+            )
+        else:
+            job_executor.submit(process_transcription_optimized, job_id, filepath)
         
         return jsonify({
             'job_id': job_id,
@@ -725,25 +1331,32 @@ def upload_file():
 
 @app.route('/status/<job_id>')
 def get_status(job_id):
-    if job_id not in transcription_jobs:
+    job = get_job(job_id)
+    if job is None:
         return jsonify({'error': 'Job not found'}), 404
-    return jsonify(transcription_jobs[job_id])
+    # Snapshot: the job thread may be updating it concurrently
+    return jsonify(dict(job))
 
 @app.route('/download/<job_id>')
 def download_file(job_id):
-    if job_id not in transcription_jobs:
+    job = get_job(job_id)
+    if job is None:
         return jsonify({'error': 'Job not found'}), 404
     
-    job = transcription_jobs[job_id]
     if job['status'] != 'completed':
         return jsonify({'error': 'Transcription not completed'}), 400
     
-    return send_file(job['output_file'], as_attachment=True, download_name=f"transcription_{job['filename']}.txt")
+    # A real path lets Werkzeug use sendfile(2) or X-Sendfile
+    return send_file(
+        job['output_file'], as_attachment=True,
+        download_name=f"transcription_{job['filename']}.txt"
+    )
 
 @app.route('/<path:path>')
 def serve_react(path):
     return send_from_directory(app.static_folder, path)
 
+@lru_cache(maxsize=None)
 def get_ffmpeg_path():
     """Get the correct ffmpeg path for the environment"""
     # Try Homebrew path first (local development)
@@ -752,6 +1365,7 @@ def get_ffmpeg_path():
     # Try system path (deployment)
     return "ffmpeg"
 
+@lru_cache(maxsize=None)
 def get_ffprobe_path():
     """Get the correct ffprobe path for the environment"""
     # Try Homebrew path first (local development)
@@ -760,6 +1374,30 @@ def get_ffprobe_path():
     # Try system path (deployment)
     return "ffprobe"
 
+@lru_cache(maxsize=1)
+def get_speech_codec_args():
+    """Get ffmpeg encoder args for 16 kHz mono speech (HE-AAC when libfdk_aac is available)"""
+    try:
+        result = subprocess.run([get_ffmpeg_path(), "-hide_banner", "-encoders"], capture_output=True, text=True)
+        if "libfdk_aac" in result.stdout:
+            return ("-c:a", "libfdk_aac", "-profile:a", "aac_he", "-b:a", "16k", "-ar", "16000")
+    except OSError:
+        pass
+    # Native AAC-LC fallback at a speech bitrate
+    return ("-c:a", "aac", "-b:a", "24k", "-profile:a", "aac_low", "-ar", "16000")
+
+@lru_cache(maxsize=1)
+def get_speech_resample_args():
+    """Get ffmpeg filter args for the 16 kHz downsample (soxr when ffmpeg is built with it)"""
+    try:
+        result = subprocess.run([get_ffmpeg_path(), "-hide_banner", "-buildconf"], capture_output=True, text=True)
+        if "--enable-libsoxr" in result.stdout:
+            return ("-af", "aresample=resampler=soxr:precision=20")
+    except OSError:
+        pass
+    # ffmpeg's built-in swr resampler is used for -ar 16000
+    return ()
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8001))  # Use PORT from environment for deployment
     app.run(debug=False, host='0.0.0.0', port=port)  # Set debug=False for production 
\ No newline at end of file
@@ -88,6 +88,8 @@ const FileUpload: React.FC<FileUploadProps> = ({ user, onJobStart }) => {
         headers: {
           'Content-Type': 'multipart/form-data',
           'X-User-ID': user.id,
+          // Lets the server verify the payment while the file is still uploading
+          ...(paymentIntentId ? { 'X-Payment-Intent-ID': paymentIntentId } : {}),
         },
       });
 
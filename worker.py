@@ -0,0 +1,18 @@
+import sys
+from rq import SimpleWorker
+import app_secure
+
+# Runs queued transcription jobs when the web app is started with REDIS_URL set.
+# Uploads and outputs live on disk, so this must share the app's working directory/volume.
+if __name__ == '__main__':
+    if not app_secure.transcription_queue:
+        print("❌ Error: REDIS_URL is not set - nothing to consume")
+        sys.exit(1)
+    
+    if app_secure.USE_LOCAL_ASR:
+        # Load the GPU model before taking jobs so the first one doesn't pay for it
+        app_secure.get_local_asr_model()
+    
+    # SimpleWorker runs jobs in this process (no fork), which keeps the
+    # shared upload event loop thread from app_secure alive for every job
+    SimpleWorker([app_secure.transcription_queue], connection=app_secure.redis_conn).work()